@@ -1,109 +1,131 @@
+import asyncio
+import functools
 import os
+from datetime import datetime
+from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv()  # Load environment variables first
 
-import openai
-# Allow OPENAI_BASE_URL from .env to override the default.
-# The OpenAI library reads env vars automatically, but setting it
-# explicitly makes local/debug runs fool-proof.
-if os.getenv("OPENAI_BASE_URL"):
-    openai.base_url = os.environ["OPENAI_BASE_URL"]
-
-# ------------------------------------------------------------------
-# Geminis OpenAI-compatible endpoint supports *chat completions*,
-# not the newer *responses* API that the Agents SDK defaults to.
-# Tell the SDK to use chat-completions globally and turn off tracing
-# (otherwise it tries to upload traces with a real OpenAI key and
-# shows the 401 youre seeing).
-# ------------------------------------------------------------------
-from agents import set_default_openai_api
-from agents.tracing import set_tracing_disabled
-
-set_default_openai_api("chat_completions")  # switch away from /v1/responses
-set_tracing_disabled(True)                 # silence 401 tracing errors
-
-from agents import Agent
-from agents.mcp import MCPServerSse, MCPServerStdio
+# Everything below is built lazily by get_agent(): importing this module
+# must stay cheap so the uvicorn worker can accept requests straight away.
+# Creating the MCP server objects opens no connections; server.py connects
+# them in the background after startup.
 
 # Define your MCP server(s)
 railway_server_url = "https://eu1.make.com/mcp/api/v1/u/2a183f33-4498-4ebe-b558-49e956ee0c29/sse"
 primary_railway_server_url = "https://primary-nj0x-production.up.railway.app/mcp/1b39de32-b22f-4323-ad9e-e332c41930ce/sse"
+# Local SSE bridges in front of the stdio servers (see start.sh)
+supabase_mcp_url = os.getenv("SUPABASE_MCP_URL", "http://127.0.0.1:8811/sse")
+slack_mcp_url = os.getenv("SLACK_MCP_URL", "http://127.0.0.1:8812/sse")
 
-# Original Make.com MCP server
-railway_mcp_server = MCPServerSse(
-    name="railway",
-    params={"url": railway_server_url},
-    client_session_timeout_seconds=60.0,  # Increased timeout to 60 seconds
-    cache_tools_list=True
-)
-
-# Your primary Railway-hosted MCP server
-primary_railway_mcp_server = MCPServerSse(
-    name="primary_railway",
-    params={"url": primary_railway_server_url},
-    client_session_timeout_seconds=60.0,  # Increased timeout to 60 seconds
-    cache_tools_list=True
-)
-
-# --- Supabase MCP Server definition ---
-supabase_access_token = os.getenv("SUPABASE_ACCESS_TOKEN")
-if not supabase_access_token:
-    print("WARNING: SUPABASE_ACCESS_TOKEN is not set. Supabase MCP may not start correctly.")
-
-supabase_mcp_server = MCPServerStdio(
-    name="supabase",
-    params={
-        # Use the right shell command per OS
-        "command": "cmd" if os.name == "nt" else "npx",
-        "args": (
-            ["/c", "npx", "-y", "@supabase/mcp-server-supabase@latest", "--access-token", supabase_access_token or ""]
-            if os.name == "nt"
-            else ["-y", "@supabase/mcp-server-supabase@latest", "--access-token", supabase_access_token or ""]
-        ),
-        "env": {
-            # npx under some shells insists that this exists
-            "XDG_CONFIG_HOME": os.environ.get("XDG_CONFIG_HOME", "/tmp"),
-        }
-        # Optionally, add 'cwd' here if needed.
-    },
-    client_session_timeout_seconds=120.0,   # supabase server needs a bit more time to start
-    cache_tools_list=True
-)
-
-# --- Slack MCP Server definition ---
-slack_bot_token = os.getenv("SLACK_BOT_TOKEN")
-slack_team_id = os.getenv("SLACK_TEAM_ID")
-if not slack_bot_token or not slack_team_id:
-    print("WARNING: SLACK_BOT_TOKEN or SLACK_TEAM_ID is not set. Slack MCP may not start correctly.")
-
-slack_mcp_server = MCPServerStdio(
-    name="slack",
-    params={
-        "command": "npx",
-        "args": [
-            "-y",
-            "@modelcontextprotocol/server-slack"
-        ],
-        "env": {
-            "SLACK_BOT_TOKEN": slack_bot_token or "",
-            "SLACK_TEAM_ID": slack_team_id or "",
-        }
-    },
-    # You can adjust timeout or other params as needed
-    client_session_timeout_seconds=60.0,
-)
+_agent = None
+_agent_lock = asyncio.Lock()
 
-from datetime import datetime
 
-with open(os.path.join(os.path.dirname(__file__), "system_prompt.md"), "r", encoding="utf-8") as f:
-    system_prompt = f"Current date and time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n" + f.read()
+@functools.lru_cache(maxsize=1)
+def _load_system_prompt() -> str:
+    # Kept byte-identical across turns and restarts so provider-side prompt
+    # caching can hit on it; the current time is served by a tool instead.
+    return (Path(__file__).parent / "system_prompt.md").read_text(encoding="utf-8")
+
+
+def get_current_datetime() -> str:
+    """Return the current date and time, including the UTC offset, in ISO 8601 format."""
+    return datetime.now().astimezone().isoformat(timespec="seconds")
+
+
+_sdk_configured = False
+
+
+def _configure_sdk_once():
+    """Apply the process-wide OpenAI / Agents SDK settings; later calls are no-ops."""
+    global _sdk_configured
+    if _sdk_configured:
+        return
+    _sdk_configured = True
+
+    import openai
+    # Allow OPENAI_BASE_URL from .env to override the default.
+    # The OpenAI library reads env vars automatically, but setting it
+    # explicitly makes local/debug runs fool-proof.
+    # An empty OPENAI_BASE_URL= line counts as unset.
+    base_url = os.environ.get("OPENAI_BASE_URL")
+    if base_url:
+        openai.base_url = base_url
+
+    # ------------------------------------------------------------------
+    # Geminis OpenAI-compatible endpoint supports *chat completions*,
+    # not the newer *responses* API that the Agents SDK defaults to.
+    # Tell the SDK to use chat-completions globally and turn off tracing
+    # (otherwise it tries to upload traces with a real OpenAI key and
+    # shows the 401 youre seeing).
+    # ------------------------------------------------------------------
+    from agents import set_default_openai_api
+    from agents.tracing import set_tracing_disabled
+
+    set_default_openai_api("chat_completions")  # switch away from /v1/responses
+    set_tracing_disabled(True)                 # silence 401 tracing errors
+
+
+def _build_agent():
+    _configure_sdk_once()
+
+    from agents import Agent, function_tool
+    from mcp_cache import CachedMCPServerSse
+    from tool_profile import MCP_TOOL_PROFILE, expand_tools
+
+    # Original Make.com MCP server
+    railway_mcp_server = CachedMCPServerSse(
+        name="railway",
+        params={"url": railway_server_url},
+        client_session_timeout_seconds=60.0,  # Increased timeout to 60 seconds
+        cache_tools_list=True
+    )
+
+    # Your primary Railway-hosted MCP server
+    primary_railway_mcp_server = CachedMCPServerSse(
+        name="primary_railway",
+        params={"url": primary_railway_server_url},
+        client_session_timeout_seconds=60.0,  # Increased timeout to 60 seconds
+        cache_tools_list=True
+    )
+
+    # --- Supabase & Slack MCP servers ---
+    # Both are stdio servers. start.sh runs a single copy of each per container
+    # behind a local stdio->SSE bridge, and the agent connects to those over SSE.
+    supabase_mcp_server = CachedMCPServerSse(
+        name="supabase",
+        params={"url": supabase_mcp_url},
+        client_session_timeout_seconds=120.0,   # supabase server needs a bit more time to start
+        cache_tools_list=True
+    )
+
+    slack_mcp_server = CachedMCPServerSse(
+        name="slack",
+        params={"url": slack_mcp_url},
+        # You can adjust timeout or other params as needed
+        client_session_timeout_seconds=60.0,
+        cache_tools_list=True
+    )
+
+    tools = [function_tool(get_current_datetime)]
+    if MCP_TOOL_PROFILE != "full":
+        tools.append(function_tool(expand_tools))
+
+    return Agent(
+        name="SlackAssistant",
+        model=os.getenv("AGENT_MODEL", "gpt-4o"),
+        instructions=_load_system_prompt(),
+        tools=tools,
+        mcp_servers=[primary_railway_mcp_server, supabase_mcp_server, slack_mcp_server],  # Replaced hubspot_mcp_server with supabase_mcp_server
+    )
 
-_agent = Agent(
-    name="SlackAssistant",
-    model=os.getenv("AGENT_MODEL", "gpt-4o"),
-    instructions=system_prompt,
-    mcp_servers=[primary_railway_mcp_server, supabase_mcp_server, slack_mcp_server],  # Replaced hubspot_mcp_server with supabase_mcp_server
-)
 
-# For easier access in server.py, you can create a list of active servers
-ACTIVE_MCP_SERVERS = _agent.mcp_servers if _agent.mcp_servers else []
+async def get_agent():
+    """Return the shared SlackAssistant agent, building it on first use."""
+    global _agent
+    if _agent is None:
+        async with _agent_lock:
+            if _agent is None:
+                _agent = _build_agent()
+    return _agent
@@ -0,0 +1,48 @@
+"""
+Per-server circuit breaker for MCP reconnects.
+
+When an MCP server is down, repairing its session on every request would make
+each request wait out the connect timeout. After MCP_BREAKER_FAILURE_THRESHOLD
+consecutive failed connects the breaker opens: requests stop trying and run
+without the server, and only the heartbeat reconnects it. The heartbeat also
+waits MCP_BREAKER_RESET_SECONDS before its next attempt (half-open), whose
+outcome closes or re-opens the breaker.
+"""
+
+import time
+
+MCP_BREAKER_FAILURE_THRESHOLD = 2
+MCP_BREAKER_RESET_SECONDS = 30.0
+
+
+class MCPBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = MCP_BREAKER_FAILURE_THRESHOLD, reset_seconds: float = MCP_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        """Whether a reconnect attempt may be made now."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            # Let exactly one probe through; others are refused until it reports back.
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def on_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
@@ -0,0 +1,178 @@
+"""
+Disk-backed tool-list cache for MCP servers.
+
+The Agents SDK only caches ``list_tools()`` in memory, so every process start
+pays one round-trip per server before the first agent turn. The wrappers below
+persist the last-seen tool schemas to disk, serve them straight away on a cold
+start and, if the file is older than MCP_TOOLS_REFRESH_INTERVAL_SECONDS,
+refresh them from the live server in the background.
+"""
+
+import abc
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import httpx2 as httpx  # MCP Python SDK v2 only accepts httpx2 clients
+except ImportError:
+    import httpx
+from agents.mcp import MCPServerSse
+from mcp import Tool as MCPTool
+
+from tool_profile import LeanToolsMixin
+from tool_speculation import SpeculativeToolCallsMixin
+
+logger = logging.getLogger(__name__)
+
+MCP_TOOLS_CACHE_DIR = Path(
+    os.getenv("MCP_TOOLS_CACHE_DIR", str(Path.home() / ".cache" / "slack_agent" / "mcp"))
+)
+# A cache file refreshed more recently than this is trusted without asking the server.
+MCP_TOOLS_REFRESH_INTERVAL_SECONDS = float(os.getenv("MCP_TOOLS_REFRESH_INTERVAL_SECONDS", "600"))
+
+# HTTP/2 needs the optional h2 package (httpx[http2]); without it httpx stays on HTTP/1.1.
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _schema_hash(serialized_tools: list) -> str:
+    return hashlib.sha256(json.dumps(serialized_tools, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class _DiskCachedToolsMixin(abc.ABC):
+    """Adds a persistent tools-list cache on top of the SDK's in-memory one.
+
+    Only active when the server is created with ``cache_tools_list=True``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_tools: list[MCPTool] | None = None
+        self._cached_schema_hash: str | None = None
+        self._last_refresh_ts: float | None = None
+        self._disk_cache_checked = False
+        self._refresh_task: asyncio.Task | None = None
+
+    @abc.abstractmethod
+    def _cache_identity(self) -> str:
+        """A stable string identifying the server the tools came from."""
+
+    @property
+    def cached_tools(self) -> list[MCPTool] | None:
+        """The tools list currently served to the agent, without any I/O."""
+        return self._cached_tools
+
+    @property
+    def tools_schema_hash(self) -> str | None:
+        """SHA256 of the last tools list seen on disk or on the wire, if any."""
+        return self._cached_schema_hash
+
+    @property
+    def tools_cache_path(self) -> Path:
+        digest = hashlib.sha256(self._cache_identity().encode("utf-8")).hexdigest()
+        return MCP_TOOLS_CACHE_DIR / f"{digest}.json"
+
+    def _read_tools_cache(self) -> list[MCPTool] | None:
+        try:
+            payload = json.loads(self.tools_cache_path.read_text(encoding="utf-8"))
+            tools = [MCPTool.model_validate(tool) for tool in payload["tools"]]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Ignoring unreadable tools cache for '%s': %s", self.name, e)
+            return None
+        self._cached_schema_hash = payload.get("schema_hash")
+        self._last_refresh_ts = payload.get("last_refresh_ts")
+        return tools
+
+    def _tools_cache_is_stale(self) -> bool:
+        if self._last_refresh_ts is None:
+            return True
+        return time.time() - self._last_refresh_ts > MCP_TOOLS_REFRESH_INTERVAL_SECONDS
+
+    def _write_tools_cache(self, tools: list[MCPTool]) -> None:
+        serialized = [tool.model_dump(mode="json", exclude_none=True) for tool in tools]
+        schema_hash = _schema_hash(serialized)
+        # Rewritten even when the schemas are unchanged, to record the refresh time.
+        refreshed_at = time.time()
+        path = self.tools_cache_path
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"server": self.name, "schema_hash": schema_hash, "last_refresh_ts": refreshed_at, "tools": serialized},
+                    f,
+                )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write tools cache for '%s': %s", self.name, e)
+            return
+        self._cached_schema_hash = schema_hash
+        self._last_refresh_ts = refreshed_at
+
+    async def _refresh_tools(self, *args, **kwargs) -> None:
+        try:
+            tools = await super().list_tools(*args, **kwargs)
+        except Exception as e:
+            logger.warning("Background tools refresh for '%s' failed: %s", self.name, e)
+            return
+        # Single reference swap: callers see either the old list or the new one.
+        self._cached_tools = tools
+        self._write_tools_cache(tools)
+
+    def invalidate_tools_cache(self):
+        super().invalidate_tools_cache()
+        self._cached_tools = None
+
+    async def list_tools(self, *args, **kwargs) -> list[MCPTool]:
+        if not self.cache_tools_list:
+            return await super().list_tools(*args, **kwargs)
+
+        if not self._disk_cache_checked:
+            self._disk_cache_checked = True
+            self._cached_tools = self._read_tools_cache()
+            if self._cached_tools is not None and self._tools_cache_is_stale():
+                self._refresh_task = asyncio.create_task(self._refresh_tools(*args, **kwargs))
+
+        if self._cached_tools is not None:
+            return self._cached_tools
+
+        tools = await super().list_tools(*args, **kwargs)
+        self._cached_tools = tools
+        self._write_tools_cache(tools)
+        return tools
+
+
+def keepalive_http_client(headers=None, timeout=None, auth=None) -> httpx.AsyncClient:
+    """``httpx_client_factory`` for SSE servers: keeps connections (and TLS sessions) alive between requests.
+
+    The MCP SSE client opens one client per connection and closes it on
+    disconnect, so reuse happens within a session: the SSE stream, the
+    message POSTs and the heartbeat pings all share its pool.
+    """
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout or httpx.Timeout(60.0, connect=5.0),
+        auth=auth,
+        http2=_HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300.0),
+    )
+
+
+class CachedMCPServerSse(SpeculativeToolCallsMixin, LeanToolsMixin, _DiskCachedToolsMixin, MCPServerSse):
+    """``MCPServerSse`` whose tools list survives process restarts."""
+
+    def __init__(self, params, *args, **kwargs):
+        params = {"httpx_client_factory": keepalive_http_client, **params}
+        super().__init__(params, *args, **kwargs)
+
+    def _cache_identity(self) -> str:
+        return self.params["url"]
+
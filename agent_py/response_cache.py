@@ -0,0 +1,59 @@
+"""
+In-process cache of complete /generate streams.
+
+Slack users repeat themselves a lot (retries, the same question asked twice in
+a channel). A finished stream is stored under a content hash of everything
+that determines the agent's answer, and an identical request replays the
+stored lines instead of running the agent again.
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import orjson
+
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+
+
+def response_cache_key(model, instructions, messages, tools_fingerprint) -> str:
+    payload = orjson.dumps(
+        [str(model), instructions, messages, tools_fingerprint],
+        option=orjson.OPT_SORT_KEYS,
+        default=str,
+    )
+    return hashlib.blake2b(payload, digest_size=32).hexdigest()
+
+
+class ResponseCache:
+    """A TTL + LRU bounded mapping of cache key -> the stream lines of one response."""
+
+    def __init__(self, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, list[bytes]]] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> list[bytes] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, lines = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return lines
+
+    def set(self, key: str, lines: list[bytes]) -> None:
+        if not self.enabled:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, lines)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -1,272 +1,922 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
-from fastapi.responses import StreamingResponse
-import json
+from fastapi import Depends, FastAPI, Header, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
 import asyncio
-import traceback # Import traceback
+import atexit
+from contextlib import aclosing, asynccontextmanager
+from collections.abc import AsyncIterator
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from collections import OrderedDict
+import orjson
 import anyio  # For ClosedResourceError handling
 
 # The Agents SDK usually installs an *agents* top-level package.
 # If it isnt importable (e.g. the wheel exposes `openai_agents`
 # instead), fall back gracefully:
 try:
-    from agents import Runner          # normal path (openai-agents  0.0.7)
+    from agents import ModelSettings, RunConfig, Runner          # normal path (openai-agents  0.0.7)
     from agents.exceptions import ModelBehaviorError
 except ModuleNotFoundError:
-    from openai_agents import Runner   # fallback for some installs
+    from openai_agents import ModelSettings, RunConfig, Runner   # fallback for some installs
     from openai_agents.exceptions import ModelBehaviorError
-from custom_slack_agent import _agent, ACTIVE_MCP_SERVERS
+# Resolved once: stream_agent_events calls this for every request.
+_run_streamed = Runner.run_streamed
+from custom_slack_agent import get_agent
+from mcp_breaker import MCPBreaker
+from mcp.types import CONNECTION_CLOSED
+try:
+    from mcp.shared.exceptions import MCPError
+    from mcp.types import REQUEST_TIMEOUT
+except ImportError:  # MCP Python SDK v1
+    from mcp.shared.exceptions import McpError as MCPError
+    REQUEST_TIMEOUT = 408  # v1 reports its own request timeouts with the HTTP code
+from response_cache import ResponseCache, response_cache_key
+
+from openai.types.responses import ResponseOutputItemAddedEvent, ResponseTextDeltaEvent
+from tool_profile import begin_tool_session
+from tool_speculation import ToolSpeculator
+
+# Uvicorn only configures its own loggers; route ours to stderr too. Debug
+# logging is off unless LOG_LEVEL=DEBUG, which keeps the hot path quiet.
+# Handlers that actually write are moved behind a queue, so the event loop
+# only enqueues records and a listener thread does the blocking I/O.
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    # The listener lives in this process, so records are queued untouched and
+    # formatted by the real handler (uvicorn's access formatter reads record.args).
+    def prepare(self, record):
+        return record
+
+
+def _move_handlers_to_queue(target_logger):
+    handlers = target_logger.handlers[:]
+    if not handlers or any(isinstance(h, logging.handlers.QueueHandler) for h in handlers):
+        return None
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        target_logger.removeHandler(handler)
+    target_logger.addHandler(_InProcessQueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# LOG_LEVEL applies to this service's own modules; third-party loggers (httpx,
+# openai, mcp, ...) inherit the root's WARNING so LOG_LEVEL=DEBUG stays readable.
+logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+for _logger_name in (__name__, "mcp_cache", "tool_speculation"):
+    logging.getLogger(_logger_name).setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+for _logger_name in ("", "uvicorn", "uvicorn.access"):
+    _move_handlers_to_queue(logging.getLogger(_logger_name))
+logger = logging.getLogger(__name__)
+
+class OrjsonResponse(JSONResponse):
+    """JSON responses rendered by orjson.
+
+    Same idea as fastapi.responses.ORJSONResponse, which newer FastAPI releases
+    deprecate; this works the same across the FastAPI versions we support.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+response_cache = ResponseCache()
+
+# --- MCP connection lifecycle ---
+# MCP sessions are opened once, in the background right after startup, and
+# shared by every request through app.state.mcp (server name -> server).
+# Building the agent happens there too, so the worker accepts requests
+# immediately; the stdio servers themselves run behind the SSE bridges that
+# start.sh launches.
+# A background heartbeat pings each session and reconnects it if the ping fails.
+# A server whose session broke during a request is flagged unhealthy; the next
+# request probes it and reconnects it only if the probe fails. Requests never
+# wait on a reconnect that startup or the heartbeat already has in flight, nor
+# on a server whose circuit breaker is not closed: they run without it.
+MCP_HEARTBEAT_INTERVAL_SECONDS = 30.0
+MCP_HEARTBEAT_TIMEOUT_SECONDS = 10.0
+MCP_CONNECT_ATTEMPTS = 2
+MCP_CONNECT_RETRY_DELAY_SECONDS = 2.0  # local MCP bridges start alongside the API
+MCP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("MCP_CONNECT_TIMEOUT_SECONDS", "15"))
+MCP_CONNECT_CONCURRENCY = 5
+# How long after startup requests may wait for the initial connects; servers
+# still connecting after that are left out until they are up.
+MCP_STARTUP_WAIT_SECONDS = float(os.getenv("MCP_STARTUP_WAIT_SECONDS", "3"))
+
+_mcp_reconnect_locks: dict[str, asyncio.Lock] = {}
+_mcp_connect_semaphore = asyncio.Semaphore(MCP_CONNECT_CONCURRENCY)
+_mcp_healthy: dict[str, bool] = {}
+_mcp_breakers: dict[str, MCPBreaker] = {}
+
+
+def _get_reconnect_lock(server_instance) -> asyncio.Lock:
+    lock = _mcp_reconnect_locks.get(server_instance.name)
+    if lock is None:
+        lock = _mcp_reconnect_locks[server_instance.name] = asyncio.Lock()
+    return lock
+
+
+async def _open_mcp_session(server_instance):
+    """connect(), bounded in time and in how many servers connect at once.
+
+    A server that hangs while connecting would otherwise stall startup or a
+    heartbeat reconnect until its own client session timeout.
+    """
+    async with _mcp_connect_semaphore:
+        try:
+            await asyncio.wait_for(server_instance.connect(), timeout=MCP_CONNECT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            await server_instance.cleanup()
+            raise TimeoutError(f"connect timed out after {MCP_CONNECT_TIMEOUT_SECONDS:g}s") from None
+
+
+async def _reconnect_mcp_server(server_instance) -> bool:
+    """Tear down and re-open the session of a single MCP server.
+
+    Returns False without touching the session if another caller repaired it
+    while this one waited for the lock.
+    """
+    lock = _get_reconnect_lock(server_instance)
+    contended = lock.locked()
+    async with lock:
+        if contended:
+            try:
+                await _ping_mcp_server(server_instance)
+            except Exception:
+                pass
+            else:
+                return False
+        await server_instance.cleanup()
+        if hasattr(server_instance, 'cache_tools_list') and server_instance.cache_tools_list:
+            if hasattr(server_instance, 'invalidate_tools_cache'):
+                server_instance.invalidate_tools_cache()
+        await _open_mcp_session(server_instance)
+        return True
+
+
+async def _ping_mcp_server(server_instance):
+    # The tools list is cached, so list_tools() would not touch the wire;
+    # a ping is the cheapest call that actually exercises the session.
+    # Only a timeout or a transport failure means the session is dead; an error
+    # reply (e.g. "Method not found" from a server without ping) proves it alive.
+    session = getattr(server_instance, 'session', None)
+    if session is None:
+        raise RuntimeError("session is not connected")
+    try:
+        await asyncio.wait_for(session.send_ping(), timeout=MCP_HEARTBEAT_TIMEOUT_SECONDS)
+    except MCPError as e:
+        # These two are raised locally by the client session, not sent by the server.
+        if e.error.code in (CONNECTION_CLOSED, REQUEST_TIMEOUT):
+            raise
+        logger.debug("MCP server '%s' answered ping with an error (%s); session is alive.", server_instance.name, e)
+
+
+def _get_breaker(server_instance) -> MCPBreaker:
+    breaker = _mcp_breakers.get(server_instance.name)
+    if breaker is None:
+        breaker = _mcp_breakers[server_instance.name] = MCPBreaker()
+    return breaker
+
+
+def _mark_mcp_unhealthy(mcp_servers):
+    for server_instance in mcp_servers:
+        _mcp_healthy[server_instance.name] = False
+
+
+async def _ensure_mcp_healthy(server_instance):
+    """Probe a server flagged unhealthy and reconnect it if the probe fails; healthy servers cost nothing."""
+    if _mcp_healthy.get(server_instance.name, True):
+        return
+    if _get_reconnect_lock(server_instance).locked():
+        logger.debug("MCP server '%s' is already reconnecting; not waiting for it.", server_instance.name)
+        return
+    breaker = _get_breaker(server_instance)
+    if breaker.state != MCPBreaker.CLOSED:
+        logger.debug("Circuit open for MCP server '%s'; leaving it to the heartbeat.", server_instance.name)
+        return
+    try:
+        await _ping_mcp_server(server_instance)
+    except Exception as ping_err:
+        logger.warning("MCP server '%s' is unhealthy (%s). Reconnecting...", server_instance.name, ping_err)
+        try:
+            reconnected = await _reconnect_mcp_server(server_instance)
+        except Exception as reconnect_err:
+            breaker.on_failure()
+            logger.error("Reconnect to MCP server '%s' failed: %s", server_instance.name, reconnect_err)
+            return
+        if reconnected:
+            logger.info("Reconnected to MCP server '%s'.", server_instance.name)
+    breaker.on_success()
+    _mcp_healthy[server_instance.name] = True
+
+
+async def _mcp_heartbeat(mcp_servers):
+    while True:
+        await asyncio.sleep(MCP_HEARTBEAT_INTERVAL_SECONDS)
+        for server_instance in mcp_servers:
+            try:
+                await _ping_mcp_server(server_instance)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ping_err:
+                # Keep requests off the session while it is being replaced.
+                _mcp_healthy[server_instance.name] = False
+                breaker = _get_breaker(server_instance)
+                if not breaker.allow():
+                    logger.debug("MCP server '%s' failed heartbeat (%s); circuit open, retrying later.", server_instance.name, ping_err)
+                    continue
+                logger.warning("MCP server '%s' failed heartbeat (%s). Reconnecting...", server_instance.name, ping_err)
+                try:
+                    if await _reconnect_mcp_server(server_instance):
+                        logger.info("Reconnected to MCP server '%s'.", server_instance.name)
+                except Exception as reconnect_err:
+                    breaker.on_failure()
+                    logger.error("Reconnect to MCP server '%s' failed: %s", server_instance.name, reconnect_err)
+                    continue
+            _mcp_healthy[server_instance.name] = True
+            _get_breaker(server_instance).on_success()
 
-from openai.types.responses import ResponseTextDeltaEvent
 
-app = FastAPI(title="Slack-Agent API")
+async def _connect_mcp_server(server_instance):
+    """Connect a single MCP server, retrying once before giving up.
 
-# --- Application Startup Event ---
-@app.on_event("startup")
-async def startup_event():
-    print("PY_AGENT_INFO (startup): Application startup event triggered.")
-    if ACTIVE_MCP_SERVERS:
-        print(f"PY_AGENT_INFO (startup): Attempting to connect to {len(ACTIVE_MCP_SERVERS)} MCP server(s) on startup...")
-        for server_instance in ACTIVE_MCP_SERVERS:
+    Holds the server's reconnect lock throughout, so requests arriving
+    meanwhile run without the server instead of trying to connect it too.
+    """
+    async with _get_reconnect_lock(server_instance):
+        for attempt in range(1, MCP_CONNECT_ATTEMPTS + 1):
             try:
-                # Invalidate cache before initial connect if caching is enabled
-                if hasattr(server_instance, 'cache_tools_list') and server_instance.cache_tools_list:
-                    if hasattr(server_instance, 'invalidate_tools_cache'):
-                        server_instance.invalidate_tools_cache()
-                        print(f"PY_AGENT_DEBUG (startup): Invalidated tools cache for MCP server '{server_instance.name}'.")
-                await server_instance.connect()
-                print(f"PY_AGENT_INFO (startup): Successfully connected to MCP server '{server_instance.name}'.")
+                await _open_mcp_session(server_instance)
+                _mcp_healthy[server_instance.name] = True
+                logger.info("Successfully connected to MCP server '%s'.", server_instance.name)
+                return
             except Exception as e:
-                print(f"PY_AGENT_ERROR (startup): Failed to connect to MCP server '{server_instance.name}' on startup: {e}")
-                print(f"PY_AGENT_ERROR (startup): Traceback: {traceback.format_exc()}")
+                logger.error("Failed to connect to MCP server '%s' on startup (attempt %d/%d): %s", server_instance.name, attempt, MCP_CONNECT_ATTEMPTS, e)
+                # Every failed attempt counts, so a server that never came up
+                # starts with its breaker open and requests do not retry it.
+                _get_breaker(server_instance).on_failure()
+                if attempt == MCP_CONNECT_ATTEMPTS:
+                    raise
+                await server_instance.cleanup()
+                await asyncio.sleep(MCP_CONNECT_RETRY_DELAY_SECONDS)
+
+
+async def _start_mcp_servers(state):
+    agent = await get_agent()
+    mcp_servers = agent.mcp_servers or []
+    state.mcp.update((server_instance.name, server_instance) for server_instance in mcp_servers)
+    if not mcp_servers:
+        logger.info("No active MCP servers configured for initial connection.")
+        return
+    logger.info("Attempting to connect to %d MCP server(s) on startup...", len(mcp_servers))
+    _mark_mcp_unhealthy(mcp_servers)  # until each one's connect succeeds
+    # Connect concurrently so startup takes as long as the slowest server, not the sum of all.
+    results = await asyncio.gather(
+        *(_connect_mcp_server(server_instance) for server_instance in mcp_servers),
+        return_exceptions=True,
+    )
+    for server_instance, result in zip(mcp_servers, results):
+        if isinstance(result, BaseException):
+            logger.error("MCP server '%s' is unavailable; the heartbeat will keep retrying.", server_instance.name)
+    state.mcp_heartbeat_task = asyncio.create_task(_mcp_heartbeat(mcp_servers))
+
+
+async def get_ready_agent(state):
+    """Return the agent with the MCP servers that are usable right now.
+
+    Servers that are still connecting, reconnecting, or unhealthy (failed
+    reconnect, or breaker open) are left out of this request's agent, so one
+    dead or hanging server neither fails nor delays every run.
+    """
+    agent = await get_agent()
+    startup_task = state.mcp_startup_task
+    if startup_task is not None and not startup_task.done():
+        remaining = state.mcp_startup_deadline - time.monotonic()
+        if remaining > 0:
+            await asyncio.wait({startup_task}, timeout=remaining)
+    mcp_servers = list(state.mcp.values())
+    await asyncio.gather(*(_ensure_mcp_healthy(server_instance) for server_instance in mcp_servers))
+    agent_servers = agent.mcp_servers or []
+    healthy_servers = [server_instance for server_instance in agent_servers if _mcp_healthy.get(server_instance.name, True)]
+    if len(healthy_servers) == len(agent_servers):
+        return agent
+    # The heartbeat already logs every failed reconnect; this is per request.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Running without unhealthy MCP server(s): %s",
+            ", ".join(server_instance.name for server_instance in agent_servers if server_instance not in healthy_servers),
+        )
+    return agent.clone(mcp_servers=healthy_servers)
+
+
+# --- Application lifespan ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Application startup event triggered.")
+    app.state.mcp_startup_deadline = time.monotonic() + MCP_STARTUP_WAIT_SECONDS
+    app.state.mcp_startup_task = asyncio.create_task(_start_mcp_servers(app.state))
+    try:
+        yield
+    finally:
+        logger.info("Application shutdown event triggered.")
+        for task in (app.state.mcp_startup_task, app.state.mcp_heartbeat_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        # One at a time, in reverse connect order: each cleanup tears down its own task group.
+        for server_instance in reversed(list(app.state.mcp.values())):
+            await server_instance.cleanup()
+            logger.info("Closed MCP server '%s'.", server_instance.name)
+
+
+app = FastAPI(title="Slack-Agent API", lifespan=lifespan, default_response_class=OrjsonResponse)
+app.state.mcp = {}
+app.state.mcp_startup_task = None
+app.state.mcp_startup_deadline = 0.0
+app.state.mcp_heartbeat_task = None
+
+# Keys forwarded to the agent for each role in the client-supplied history.
+HISTORY_ALLOWED_KEYS = {
+    "tool": ("role", "content", "tool_call_id", "name"),
+    "assistant": ("role", "content", "tool_calls"),
+    "user": ("role", "content"),
+}
+DEFAULT_HISTORY_KEYS = ("role", "content")
+_HISTORY_KEY_SETS = {role: frozenset(keys) for role, keys in HISTORY_ALLOWED_KEYS.items()}
+
+# OpenAI routes requests that share a prompt_cache_key to the same prompt cache,
+# so every turn of a Slack thread can reuse the previous turn's prefix. Only sent
+# to OpenAI itself; OpenAI-compatible endpoints (e.g. Gemini) may reject the field.
+SEND_PROMPT_CACHE_KEY = not os.getenv("OPENAI_BASE_URL")
+
+
+def _run_config_for_session(session_id):
+    if not session_id or not SEND_PROMPT_CACHE_KEY:
+        return None
+    prompt_cache_key = hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32]
+    return RunConfig(model_settings=ModelSettings(extra_body={"prompt_cache_key": prompt_cache_key}))
+
+
+# Per-role projections onto HISTORY_ALLOWED_KEYS.
+def _clean_default_message(hist_msg):
+    return {"role": hist_msg["role"], "content": hist_msg["content"]}
+
+
+def _clean_assistant_message(hist_msg):
+    if "tool_calls" in hist_msg:
+        return {"role": "assistant", "content": hist_msg["content"], "tool_calls": hist_msg["tool_calls"]}
+    return {"role": "assistant", "content": hist_msg["content"]}
+
+
+def _clean_tool_message(hist_msg):
+    cleaned = {"role": "tool", "content": hist_msg["content"]}
+    if "tool_call_id" in hist_msg:
+        cleaned["tool_call_id"] = hist_msg["tool_call_id"]
+    if "name" in hist_msg:
+        cleaned["name"] = hist_msg["name"]
+    return cleaned
+
+
+_HISTORY_CLEANERS = {
+    "assistant": _clean_assistant_message,
+    "tool": _clean_tool_message,
+}
+
+
+def _is_clean_history_message(hist_msg):
+    """True if cleaning hist_msg would return an identical copy of it."""
+    if type(hist_msg) is not dict or "content" not in hist_msg:
+        return False
+    allowed = _HISTORY_KEY_SETS.get(hist_msg.get("role"))
+    return allowed is not None and hist_msg.keys() <= allowed
+
+
+def _order_tool_results(messages):
+    """Put the tool results that follow an assistant tool-call message in tool_calls order, in place.
+
+    Clients may append parallel tool results in completion order; a fixed order
+    keeps the serialized history, and so the cacheable prompt prefix, stable.
+    """
+    i = 0
+    while i < len(messages):
+        message = messages[i]
+        i += 1
+        tool_calls = message.get("tool_calls") if message["role"] == "assistant" else None
+        if not tool_calls or not isinstance(tool_calls, list):
+            continue
+        j = i
+        while j < len(messages) and messages[j]["role"] == "tool":
+            j += 1
+        if j - i > 1:
+            position = {call.get("id"): n for n, call in enumerate(tool_calls) if isinstance(call, dict)}
+            messages[i:j] = sorted(messages[i:j], key=lambda m: position.get(m.get("tool_call_id"), len(position)))
+        i = j
+
+
+# Slack threads resend their whole history every turn. Per session, remember the
+# raw history seen last time and its cleaned form; when the new history starts
+# with exactly the same messages (compared in C, not re-cleaned), only the new
+# tail is cleaned.
+HISTORY_CACHE_MAX_SESSIONS = 256
+_history_cache: OrderedDict[str, tuple[list, list]] = OrderedDict()
+
+
+def _clean_messages(history):
+    # Most clients already send clean messages; those are passed through without copying each dict.
+    if all(map(_is_clean_history_message, history)):
+        return list(history)
+    # System messages are dropped so only the agent's own system prompt is used.
+    return [
+        _HISTORY_CLEANERS.get(hist_msg["role"], _clean_default_message)(hist_msg)
+        for hist_msg in history
+        if isinstance(hist_msg, dict) and "content" in hist_msg and hist_msg.get("role") not in (None, "system")
+    ]
+
+
+def _clean_history(history, session_id=None):
+    """Return a new list with the cleaned, tool-result-ordered history."""
+    cached = _history_cache.get(session_id) if session_id else None
+    if cached is not None and len(history) >= len(cached[0]) and history[:len(cached[0])] == cached[0]:
+        raw_prefix, cleaned_prefix = cached
+        cleaned = cleaned_prefix + _clean_messages(history[len(raw_prefix):])
     else:
-        print("PY_AGENT_INFO (startup): No active MCP servers configured for initial connection.")
+        cleaned = _clean_messages(history)
+    _order_tool_results(cleaned)
+    if session_id:
+        _history_cache[session_id] = (list(history), cleaned[:])
+        _history_cache.move_to_end(session_id)
+        while len(_history_cache) > HISTORY_CACHE_MAX_SESSIONS:
+            _history_cache.popitem(last=False)
+    return cleaned
+
 
 class ChatRequest(BaseModel):
     prompt: str | list
     history: list
+    session_id: str | None = None  # e.g. "<channel>:<thread_ts>"; enables per-thread prompt caching
 
 class ChatResponse(BaseModel):
     content: str
     metadata: dict = {}
 
+
+async def _parse_chat_request(request: Request) -> ChatRequest:
+    # Validate straight from the raw body: pydantic parses and validates the JSON
+    # in one pass, instead of FastAPI decoding it to dicts first and validating those.
+    try:
+        return ChatRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        # Same error shape FastAPI gives for a body parameter: locations start at "body".
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        raise RequestValidationError(errors) from e
+
+
+# The body is read by _parse_chat_request, so document its schema explicitly.
+_CHAT_REQUEST_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": ChatRequest.model_json_schema()}},
+    }
+}
+
+# --- Stream encoding ---
+# /generate streams Server-Sent Events: one `data: <json>` frame per event.
+# Consecutive text deltas are coalesced into one llm_chunk frame. The very first
+# delta is sent at once (time to first token is unchanged). After that, a delta
+# flushes the buffer once it holds LLM_CHUNK_FLUSH_CHARS, and buffered text
+# is never held longer than LLM_CHUNK_FLUSH_SECONDS after the previous frame:
+# if the next event has not arrived by then, the stream loop flushes anyway
+# (see _events_with_flush_deadline). Every non-delta event (text done, tool
+# call started, tool output, ...) flushes pending text first, so text is never
+# held back across a tool call.
+LLM_CHUNK_FLUSH_CHARS = 64
+LLM_CHUNK_FLUSH_SECONDS = 0.02
+SSE_MEDIA_TYPE = "text/event-stream"
+# Stop Railway/Cloudflare/nginx from buffering the stream.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _encode_event(event: dict) -> bytes:
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+
+# _encode_event({"type": "llm_chunk", "data": text}) without building the dict.
+_LLM_CHUNK_PREFIX = b'data: {"type":"llm_chunk","data":'
+_EVENT_SUFFIX = b"}\n\n"
+
+
+def _encode_llm_chunk(text: str) -> bytes:
+    return _LLM_CHUNK_PREFIX + orjson.dumps(text) + _EVENT_SUFFIX
+
+
+_ERR_PREFIX = b'data: {"type":"error","data":'
+
+
+def _err(message: str) -> bytes:
+    """_encode_event({"type": "error", "data": message}) without building the dict."""
+    return _ERR_PREFIX + orjson.dumps(message) + _EVENT_SUFFIX
+
+
+class _TextDeltaBuffer:
+    def __init__(self):
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_flush: float | None = None
+
+    def add(self, delta: str) -> bytes | None:
+        self._parts.append(delta)
+        self._size += len(delta)
+        if (
+            self._last_flush is None
+            or self._size >= LLM_CHUNK_FLUSH_CHARS
+            or time.monotonic() - self._last_flush >= LLM_CHUNK_FLUSH_SECONDS
+        ):
+            return self.flush()
+        return None
+
+    @property
+    def flush_deadline(self) -> float | None:
+        """time.monotonic() by which pending text must go out, or None if nothing is pending."""
+        if not self._parts:
+            return None
+        return self._last_flush + LLM_CHUNK_FLUSH_SECONDS
+
+    def flush(self) -> bytes | None:
+        if not self._parts:
+            return None
+        line = _encode_llm_chunk("".join(self._parts))
+        self._parts.clear()
+        self._size = 0
+        self._last_flush = time.monotonic()
+        return line
+
+
+_STREAM_END = object()
+
+
+async def _events_with_flush_deadline(events, text_buffer: _TextDeltaBuffer) -> AsyncIterator:
+    """Yield the run's stream events, and None whenever buffered text hits its flush deadline first.
+
+    A task pumps the SDK's stream into a queue, so waiting for the next event
+    can time out without cancelling the stream. Events that are already
+    queued are handed over without waiting.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for event in events:
+                queue.put_nowait(event)
+        finally:
+            queue.put_nowait(_STREAM_END)
+
+    pump_task = asyncio.ensure_future(pump())
+    get_nowait = queue.get_nowait
+    try:
+        while True:
+            try:
+                event = get_nowait()
+            except asyncio.QueueEmpty:
+                deadline = text_buffer.flush_deadline
+                if deadline is None:
+                    event = await queue.get()
+                else:
+                    try:
+                        event = await asyncio.wait_for(queue.get(), timeout=deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        yield None
+                        continue
+            if event is _STREAM_END:
+                await pump_task  # re-raises the stream's error, if any
+                return
+            yield event
+    finally:
+        if pump_task.done():
+            if not pump_task.cancelled():
+                pump_task.exception()  # already raised above, or moot after an early close
+        else:
+            pump_task.cancel()
+
+
+class StreamOutcome:
+    """What happened during one agent run, as far as response caching cares."""
+
+    def __init__(self):
+        self.tool_calls = 0
+        self.failed = False
+
+    @property
+    def cacheable(self) -> bool:
+        # Tool results depend on live data and tools may have side effects,
+        # so only runs that answered from the conversation alone are replayed.
+        return not self.failed and self.tool_calls == 0
+
+
+def _tools_fingerprint(agent) -> list | None:
+    """Tool names plus each MCP server's schema hash, or None while any hash is unknown.
+
+    A server has no hash until its tools list was first loaded (from disk or
+    the wire); keying on None would let a reply built against one schema be
+    replayed after the real one turns up.
+    """
+    server_hashes = []
+    for server_instance in agent.mcp_servers or []:
+        schema_hash = getattr(server_instance, "tools_schema_hash", None)
+        if schema_hash is None:
+            return None
+        server_hashes.append([server_instance.name, schema_hash])
+    return [[tool.name for tool in agent.tools], server_hashes]
+
+
+# --- Stream event dispatch ---
+class _StreamRun:
+    """Per-request state shared by the event handlers below."""
+
+    __slots__ = ("text_buffer", "speculator", "outcome")
+
+    def __init__(self, agent, outcome):
+        self.text_buffer = _TextDeltaBuffer()
+        self.speculator = ToolSpeculator(agent.mcp_servers or [])
+        self.outcome = outcome if outcome is not None else StreamOutcome()
+
+
+def _on_text_delta(event, run):
+    return run.text_buffer.add(event.data.delta)
+
+
+def _on_output_item_added(event, run):
+    # A tool call has started; its name is known while the arguments are still streaming.
+    if getattr(event.data.item, 'type', None) == "function_call":
+        run.speculator.speculate(event.data.item.name)
+    return None
+
+
+def _ignore_raw_response(event, run):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Ignoring raw_response_event (not ResponseTextDeltaEvent). Data: %s", type(event.data))
+    return None
+
+
+def _on_run_item(event, run):
+    if getattr(event, 'name', None) == "tool_called":
+        run.outcome.tool_calls += 1
+    return None
+
+
+def _ignore_sdk_chatter(event, run):
+    return None
+
+
+def _emit_fallback(event, run):
+    event_type_str = getattr(event, 'type', 'unknown_fallback_attr')
+    event_data_raw = getattr(event, 'data', None)
+    output_event = {"type": event_type_str, "data": event_data_raw}
+    logger.debug("Streaming event (fallback): type='%s'", event_type_str)
+    # Encode once; only payloads orjson cannot serialize are stringified and encoded again.
+    try:
+        line = _encode_event(output_event)
+    except TypeError:
+        logger.debug("Event data for type '%s' is not directly JSON serializable. Converting to string.", event_type_str)
+        output_event["data"] = str(event_data_raw)
+        try:
+            line = _encode_event(output_event)
+        except TypeError as json_error:
+            logger.debug("Error serializing processed event to JSON: %s", json_error)
+            line = _err(f'JSON serialization error for event type {event_type_str}')
+    return line
+
+
+# raw_response_events (one per token) are dispatched on the type of their payload;
+# everything else on the event type. Unknown events fall back to _emit_fallback.
+RAW_RESPONSE_HANDLERS = {
+    ResponseTextDeltaEvent: _on_text_delta,
+    ResponseOutputItemAddedEvent: _on_output_item_added,
+}
+STREAM_EVENT_HANDLERS = {
+    "run_item_stream_event": _on_run_item,
+    "agent_updated_stream_event": _ignore_sdk_chatter,
+}
+
+
 # --- Streaming generator for agent events ---
 # (No longer manages connect/cleanup, only yields agent events)
-async def stream_agent_events(agent, messages, max_retries=5):
-    print(f"PY_AGENT_DEBUG (stream_agent_events): Starting agent stream. Number of messages: {len(messages)}")
+# Every chunk is already-encoded bytes, so StreamingResponse sends it as-is
+# instead of encoding a str per chunk.
+async def stream_agent_events(agent, messages, max_retries=5, outcome=None, run_config=None, mcp_pool=None) -> AsyncIterator[bytes]:
+    logger.debug("Starting agent stream. Number of messages: %d", len(messages))
     if messages:
-        print(f"PY_AGENT_DEBUG (stream_agent_events): First message: {messages[0]}")
-        print(f"PY_AGENT_DEBUG (stream_agent_events): Last message: {messages[-1]}")
+        logger.debug("First message: %s", messages[0])
+        logger.debug("Last message: %s", messages[-1])
     # For very detailed debugging of all messages (can be verbose):
-    # print(f"PY_AGENT_DEBUG (stream_agent_events): Full messages list: {messages}")
+    # logger.debug("Full messages list: %s", messages)
 
     attempt = 0
     local_messages = list(messages)
-    while attempt < max_retries:
-        try:
-            run_result = Runner.run_streamed(agent, local_messages)
-            print("PY_AGENT_DEBUG (stream_agent_events): Runner.run_streamed called, agent stream should start.")
-            async for event in run_result.stream_events():
-                # Let's log the raw event type before your processing
-                raw_event_type = 'unknown_raw'
-                if hasattr(event, 'type'):
-                    raw_event_type = event.type
-                elif hasattr(event, 'event') and isinstance(event.event, str): # For some SDK versions
-                    raw_event_type = event.event
-
-                print(f"PY_AGENT_DEBUG (stream_agent_events): Raw event from SDK: type='{raw_event_type}'")
-
-                # --- Start of your existing event processing logic for 'raw_response_event' etc.
-                if (
-                    hasattr(event, 'type') and event.type == "raw_response_event"
-                    and isinstance(event.data, ResponseTextDeltaEvent)
-                ):
-                    print(f"PY_AGENT_DEBUG (stream_agent_events): Yielding llm_chunk: {event.data.delta}")
-                    yield f"{json.dumps({'type': 'llm_chunk', 'data': event.data.delta})}\n"
-                    await asyncio.sleep(0.01)
-                    continue
-
-                if hasattr(event, 'type') and event.type == "raw_response_event":
-                    print(f"PY_AGENT_DEBUG (stream_agent_events): Ignoring raw_response_event (not ResponseTextDeltaEvent). Data: {type(event.data)}")
-                    continue
+    run = _StreamRun(agent, outcome)
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    # Hot-loop names bound to locals once per request.
+    _Delta = ResponseTextDeltaEvent
+    add_text = run.text_buffer.add
+    flush_text = run.text_buffer.flush
+    raw_handler_for = RAW_RESPONSE_HANDLERS.get
+    event_handler_for = STREAM_EVENT_HANDLERS.get
+    # Must happen before Runner.run_streamed so the run's task inherits it.
+    begin_tool_session()
+    # Speculative calls must not outlive the run: on a client disconnect
+    # (GeneratorExit at a yield) or a re-raised error the generator does not
+    # reach its end, and a leftover task would be reused by another request.
+    try:
+        while attempt < max_retries:
+            try:
+                run_result = _run_streamed(agent, local_messages, run_config=run_config)
+                logger.debug("Runner.run_streamed called, agent stream should start.")
+                async with aclosing(_events_with_flush_deadline(run_result.stream_events(), run.text_buffer)) as events:
+                    async for event in events:
+                        if event is None:  # buffered text reached its flush deadline
+                            yield flush_text()
+                            continue
+                        # One attribute lookup per event; some SDK versions name the field `event`.
+                        etype = getattr(event, 'type', None) or getattr(event, 'event', None)
+                        if debug_enabled:
+                            logger.debug("Raw event from SDK: type='%s'", etype or 'unknown_raw')
 
-                if hasattr(event, 'type') and event.type in (
-                    "agent_updated_stream_event",
-                    "run_item_stream_event",
-                ):
-                    print(f"PY_AGENT_DEBUG (stream_agent_events): Ignoring SDK chatter event: {event.type}")
-                    continue
-                
-                # Fallback processing
-                output_event = None
-                event_type_str = 'unknown_fallback'
-                event_data_processed = None
+                        if etype == "raw_response_event" and type(event.data) is _Delta:  # by far the most common event
+                            line = add_text(event.data.delta)
+                        else:
+                            # Whatever comes next may take a while (e.g. a tool run); send pending text now.
+                            pending = flush_text()
+                            if etype == "raw_response_event":
+                                line = raw_handler_for(type(event.data), _ignore_raw_response)(event, run)
+                            else:
+                                line = event_handler_for(etype, _emit_fallback)(event, run)
+                            if pending:
+                                line = pending + line if line else pending
+                        if line:
+                            # No pacing sleep: StreamingResponse awaits send() for every
+                            # chunk, which yields to the loop and applies backpressure.
+                            yield line
+                pending = run.text_buffer.flush()
+                if pending:
+                    yield pending
+                # If we get here, the stream finished successfully, so break the retry loop
+                break
+            except ModelBehaviorError as mbe:
+                run.outcome.failed = True
+                pending = run.text_buffer.flush()
+                if pending:
+                    yield pending
+                logger.warning("ModelBehaviorError caught: %s", mbe)
+                # Try to extract the tool name from the error message
+                bad_name = None
                 try:
-                    event_type_str = getattr(event, 'type', 'unknown_fallback_attr')
-                    event_data_raw = getattr(event, 'data', None)
-                    try:
-                        json.dumps(event_data_raw) # Test serializability
-                        event_data_processed = event_data_raw
-                    except TypeError:
-                        print(f"PY_AGENT_DEBUG (stream_agent_events): Warning: Event data for type '{event_type_str}' is not directly JSON serializable. Converting to string.")
-                        event_data_processed = str(event_data_raw)
-                    output_event = {"type": event_type_str, "data": event_data_processed}
-                    print(f"PY_AGENT_DEBUG (stream_agent_events): Streaming event (fallback): type='{event_type_str}'")
-                except Exception as processing_error:
-                    print(f"PY_AGENT_DEBUG (stream_agent_events): Error processing event structure: {processing_error}")
-                    output_event = {"type": "processing_error", "data": f"Failed to process event: {str(processing_error)}"}
-                
-                if output_event:
-                    try:
-                        yield f"{json.dumps(output_event)}\n"
-                        await asyncio.sleep(0.01)
-                    except TypeError as json_error:
-                        print(f"PY_AGENT_DEBUG (stream_agent_events): Error serializing processed event to JSON: {json_error}")
-                        yield f"{json.dumps({'type': 'error', 'data': f'JSON serialization error for event type {event_type_str}'})}\n"
-                        await asyncio.sleep(0.01)
-                # --- End of your existing event processing logic
-            # If we get here, the stream finished successfully, so break the retry loop
-            break
-        except ModelBehaviorError as mbe:
-            print(f"PY_AGENT_WARNING (stream_agent_events): ModelBehaviorError caught: {mbe}")
-            # Try to extract the tool name from the error message
-            bad_name = None
-            try:
-                msg = str(mbe)
-                if "Tool " in msg and " not" in msg:
-                    bad_name = msg.split("Tool ")[1].split(" not")[0]
-            except Exception:
-                pass
-            if bad_name:
-                correction_msg = {
-                    "role": "user",
-                    "content": f"The tool you tried to use ('{bad_name}') does not exist. Please try again without using that tool."
-                }
-                local_messages.append(correction_msg)
-                print(f"PY_AGENT_DEBUG (stream_agent_events): Appended corrective user message for bad tool '{bad_name}'. Retrying (attempt {attempt+1}/{max_retries})...")
-            else:
-                print(f"PY_AGENT_DEBUG (stream_agent_events): Could not extract bad tool name from error. Not retrying further.")
-                raise
-            attempt += 1
-            await asyncio.sleep(0.1)
-            continue
-        except Exception as e:
-            # This will catch errors from Runner.run_streamed or during the async for loop setup
-            print(f"PY_AGENT_ERROR (stream_agent_events): Exception during agent streaming execution: {str(e)}")
-            print(f"PY_AGENT_ERROR (stream_agent_events): Traceback: {traceback.format_exc()}")
-
-            # Check if it's a ClosedResourceError and try to reset the MCP connection flag
-            if isinstance(e, anyio.ClosedResourceError):
-                print(f"PY_AGENT_WARNING (stream_agent_events): ClosedResourceError detected. Resetting MCP connection flag.")
-                # Try to reset the _connected flag on the global railway_mcp_server object
-                if 'railway_mcp_server' in globals():
-                    railway = globals()['railway_mcp_server']
-                    if hasattr(railway, "_connected"):
-                        try:
-                            setattr(railway, "_connected", False)
-                            print(f"PY_AGENT_DEBUG (stream_agent_events): MCP _connected flag reset to False.")
-                        except Exception as flag_err:
-                            print(f"PY_AGENT_ERROR (stream_agent_events): Could not reset MCP flag: {flag_err}")
-
-            yield f"{json.dumps({'type': 'error', 'data': f'Agent execution failed: {str(e)}'})}\n"
-            await asyncio.sleep(0.01)
-            break
-    print("PY_AGENT_DEBUG (stream_agent_events): Agent stream generator finished.")
-
-
-@app.post("/generate")
-async def generate_stream(req: ChatRequest):
-    print(f"PY_AGENT_DEBUG (/generate): Received request. Prompt type: {type(req.prompt)}")
-    if isinstance(req.prompt, list):
-        # Log only a summary if prompt is a list to avoid huge logs, e.g., for images
-        prompt_summary = []
-        for item in req.prompt:
-            if isinstance(item, dict) and item.get("type") == "input_image":
-                prompt_summary.append({"type": "input_image", "image_url_type": type(item.get("image_url")).__name__})
-            elif isinstance(item, dict) and item.get("type") == "text":
-                 prompt_summary.append({"type": "text", "text_len": len(item.get("text",""))})
-            else:
-                prompt_summary.append(str(item)[:100]) # Truncate other types
-        print(f"PY_AGENT_DEBUG (/generate): Prompt (summarized list): {prompt_summary}")
-    else:
-        print(f"PY_AGENT_DEBUG (/generate): Prompt: {str(req.prompt)[:500]}") # Truncate long strings
-
-    print(f"PY_AGENT_DEBUG (/generate): History - Number of messages: {len(req.history)}")
-    if req.history:
-        # Log summary of history
-        history_summary = [{"role": msg.get("role", "N/A"), "content_type": type(msg.get("content")).__name__} for msg in req.history]
-        print(f"PY_AGENT_DEBUG (/generate): History (summarized): {history_summary}")
-
-
-    cleaned_messages = []
-    for hist_msg in req.history:
-        if isinstance(hist_msg, dict) and "role" in hist_msg and "content" in hist_msg:
-            # Skip system messages from history to ensure only the agent's system prompt is used
-            if hist_msg["role"] == "system":
-                print(f"PY_AGENT_DEBUG (/generate): Ignoring incoming system message from history: '{str(hist_msg.get('content', ''))[:100]}...'")
-                continue  # Do not include system messages from client history
-            cleaned_msg = {"role": hist_msg["role"], "content": hist_msg["content"]}
-            if hist_msg["role"] == "tool":
-                if "tool_call_id" in hist_msg:
-                    cleaned_msg["tool_call_id"] = hist_msg["tool_call_id"]
-                if "name" in hist_msg:
-                    cleaned_msg["name"] = hist_msg["name"]
-            elif hist_msg["role"] == "assistant" and "tool_calls" in hist_msg:
-                cleaned_msg["tool_calls"] = hist_msg["tool_calls"]
-            cleaned_messages.append(cleaned_msg)
-    
+                    msg = str(mbe)
+                    if "Tool " in msg and " not" in msg:
+                        bad_name = msg.split("Tool ")[1].split(" not")[0]
+                except Exception:
+                    pass
+                if bad_name:
+                    correction_msg = {
+                        "role": "user",
+                        "content": f"The tool you tried to use ('{bad_name}') does not exist. Please try again without using that tool."
+                    }
+                    local_messages.append(correction_msg)
+                    logger.debug("Appended corrective user message for bad tool '%s'. Retrying (attempt %d/%d)...", bad_name, attempt + 1, max_retries)
+                else:
+                    logger.debug("Could not extract bad tool name from error. Not retrying further.")
+                    raise
+                attempt += 1
+                await asyncio.sleep(0.1)
+                continue
+            except Exception as e:
+                # This will catch errors from Runner.run_streamed or during the async for loop setup
+                run.outcome.failed = True
+                logger.exception("Exception during agent streaming execution: %s", e)
+
+                # A closed MCP session: the error does not say which one, so flag every
+                # server in the pool and let the next request probe them.
+                if isinstance(e, anyio.ClosedResourceError):
+                    logger.warning("ClosedResourceError detected. Marking MCP servers unhealthy.")
+                    _mark_mcp_unhealthy(mcp_pool.values() if mcp_pool is not None else agent.mcp_servers or [])
+
+                pending = run.text_buffer.flush()
+                if pending:
+                    yield pending
+                yield _err(f'Agent execution failed: {e}')
+                break
+    finally:
+        run.speculator.cancel_pending()
+    logger.debug("Agent stream generator finished.")
+
+
+@app.post("/generate", openapi_extra=_CHAT_REQUEST_OPENAPI)
+async def generate_stream(request: Request, req: ChatRequest = Depends(_parse_chat_request), x_cache_bypass: str | None = Header(default=None)):
+    # The summaries walk the whole prompt and history; only build them when they will be logged.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received request. Prompt type: %s", type(req.prompt))
+        if isinstance(req.prompt, list):
+            # Log only a summary if prompt is a list to avoid huge logs, e.g., for images
+            prompt_summary = []
+            for item in req.prompt:
+                if isinstance(item, dict) and item.get("type") == "input_image":
+                    prompt_summary.append({"type": "input_image", "image_url_type": type(item.get("image_url")).__name__})
+                elif isinstance(item, dict) and item.get("type") == "text":
+                    prompt_summary.append({"type": "text", "text_len": len(item.get("text",""))})
+                else:
+                    prompt_summary.append(str(item)[:100]) # Truncate other types
+            logger.debug("Prompt (summarized list): %s", prompt_summary)
+        else:
+            logger.debug("Prompt: %.500s", req.prompt) # Truncate long strings
+
+        logger.debug("History - Number of messages: %d", len(req.history))
+        if req.history:
+            # Log summary of history
+            history_summary = [
+                {"role": msg.get("role", "N/A"), "content_type": type(msg.get("content")).__name__} if isinstance(msg, dict) else type(msg).__name__
+                for msg in req.history
+            ]
+            logger.debug("History (summarized): %s", history_summary)
+
+    # One list for the whole request: cleaned history plus the prompt.
+    cleaned_messages = _clean_history(req.history, req.session_id)
+
     # Check type of req.prompt before appending
     if isinstance(req.prompt, str) or isinstance(req.prompt, list):
         cleaned_messages.append({"role": "user", "content": req.prompt})
     else:
         # Fallback if req.prompt is neither string nor list (should not happen with Pydantic validation)
-        print(f"PY_AGENT_WARNING (/generate): req.prompt is of unexpected type: {type(req.prompt)}. Converting to string.")
+        logger.warning("req.prompt is of unexpected type: %s. Converting to string.", type(req.prompt))
         cleaned_messages.append({"role": "user", "content": str(req.prompt)})
 
-    print(f"PY_AGENT_DEBUG (/generate): Cleaned messages prepared for agent. Count: {len(cleaned_messages)}")
+    logger.debug("Cleaned messages prepared for agent. Count: %d", len(cleaned_messages))
     if cleaned_messages:
-        print(f"PY_AGENT_DEBUG (/generate): Last cleaned message (current user prompt part): {cleaned_messages[-1]}")
+        logger.debug("Last cleaned message (current user prompt part): %s", cleaned_messages[-1])
 
-    # Per-request MCP connection check and re-establishment
-    if ACTIVE_MCP_SERVERS:
-        print(f"PY_AGENT_DEBUG (/generate): Checking/Re-establishing connection to {len(ACTIVE_MCP_SERVERS)} MCP server(s) before agent run...")
-        for server_instance in ACTIVE_MCP_SERVERS:
-            try:
-                # Always invalidate cache before connect if caching is on,
-                # as connect() might establish a new session.
-                if hasattr(server_instance, 'cache_tools_list') and server_instance.cache_tools_list:
-                    if hasattr(server_instance, 'invalidate_tools_cache'):
-                        server_instance.invalidate_tools_cache()
-                        print(f"PY_AGENT_DEBUG (/generate): Invalidated tools cache for MCP server '{server_instance.name}'.")
-                await server_instance.connect()  # Attempt to connect or re-establish
-                print(f"PY_AGENT_DEBUG (/generate): MCP server '{server_instance.name}' connect() call completed for request.")
-            except Exception as mcp_req_conn_err:
-                print(f"PY_AGENT_ERROR (/generate): Failed during per-request MCP server connect for '{server_instance.name}': {mcp_req_conn_err}")
-                # If MCP is critical, you might want to yield an error here and stop.
-                # Example:
-                # return StreamingResponse(
-                #     (f"{json.dumps({'type': 'error', 'data': f'Critical MCP connection failed for {server_instance.name}: {str(mcp_req_conn_err)}'})}\n" async for _ in []),
-                #     media_type="application/x-json-stream"
-                # )
-
-
-    async def managed_stream_wrapper():
-        print("PY_AGENT_DEBUG (managed_stream_wrapper): Starting.")
+    # MCP sessions are shared across requests; only wait if they are still starting or reconnecting.
+    agent = await get_ready_agent(request.app.state)
+
+    # Identical requests within the TTL replay the stored stream; send
+    # "X-Cache-Bypass: 1" to force a fresh run while debugging.
+    cache_key = None
+    tools_fingerprint = _tools_fingerprint(agent) if response_cache.enabled else None
+    if tools_fingerprint is not None:
+        cache_key = response_cache_key(agent.model, agent.instructions, cleaned_messages, tools_fingerprint)
+        cached_lines = None if x_cache_bypass else response_cache.get(cache_key)
+        if cached_lines is not None:
+            logger.debug("Response cache hit (%d lines).", len(cached_lines))
+
+            async def replay_cached_stream() -> AsyncIterator[bytes]:
+                for line in cached_lines:
+                    yield line
+
+            return StreamingResponse(replay_cached_stream(), media_type=SSE_MEDIA_TYPE, headers=SSE_HEADERS)
+
+    async def managed_stream_wrapper() -> AsyncIterator[bytes]:
+        logger.debug("Stream wrapper starting.")
+        outcome = StreamOutcome()
+        emitted_lines = [] if cache_key is not None else None
         try:
-            async for event_json_line in stream_agent_events(_agent, cleaned_messages, max_retries=2):
+            async for event_json_line in stream_agent_events(
+                agent, cleaned_messages, max_retries=2, outcome=outcome,
+                run_config=_run_config_for_session(req.session_id), mcp_pool=request.app.state.mcp,
+            ):
+                if emitted_lines is not None:
+                    emitted_lines.append(event_json_line)
                 yield event_json_line
+            if emitted_lines is not None and outcome.cacheable:
+                response_cache.set(cache_key, emitted_lines)
         except Exception as wrap_err:
-            print(f"PY_AGENT_ERROR (managed_stream_wrapper): Error: {wrap_err}")
-            print(f"PY_AGENT_ERROR (managed_stream_wrapper): Traceback: {traceback.format_exc()}")
+            logger.exception("Stream wrapper error: %s", wrap_err)
             try:
-                yield f"{json.dumps({'type': 'error', 'data': f'Stream wrapper error: {str(wrap_err)}'})}\n"
+                yield _err(f'Stream wrapper error: {wrap_err}')
             except Exception:
                 pass # Avoid error in error reporting
         finally:
-            print("PY_AGENT_DEBUG (managed_stream_wrapper): Finished.")
+            logger.debug("Stream wrapper finished.")
 
 
     return StreamingResponse(
         managed_stream_wrapper(),
-        media_type="application/x-json-stream"
+        media_type=SSE_MEDIA_TYPE,
+        headers=SSE_HEADERS,
     )
+
+
+if __name__ == "__main__":
+    # Ad-hoc `python server.py` runs; production goes through start.sh.
+    import uvicorn
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:  # e.g. Windows
+        loop = "asyncio"
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), loop=loop, http="httptools")
@@ -0,0 +1,39 @@
+#!/bin/sh
+# Container entrypoint.
+#
+# The supabase and slack MCP servers only speak stdio. Instead of spawning
+# an `npx` child per process, run one copy of each per container behind a
+# local SSE bridge (supergateway) and let the agent connect to them with
+# MCPServerSse. The npm packages are installed at build time (see
+# nixpacks.toml), so nothing is downloaded here.
+#
+# Each bridge feeds every SSE session into the same stdio child, and
+# JSON-RPC request ids from different sessions can collide there. The API
+# therefore runs as a single uvicorn worker holding one session per bridge
+# (shared by all requests); scale out with more containers, not --workers.
+
+SUPABASE_MCP_PORT="${SUPABASE_MCP_PORT:-8811}"
+SLACK_MCP_PORT="${SLACK_MCP_PORT:-8812}"
+
+if [ -z "$SUPABASE_ACCESS_TOKEN" ]; then
+    echo "WARNING: SUPABASE_ACCESS_TOKEN is not set. Supabase MCP may not start correctly."
+fi
+if [ -z "$SLACK_BOT_TOKEN" ] || [ -z "$SLACK_TEAM_ID" ]; then
+    echo "WARNING: SLACK_BOT_TOKEN or SLACK_TEAM_ID is not set. Slack MCP may not start correctly."
+fi
+
+# Restart a bridge if it ever exits.
+run_bridge() {
+    while true; do
+        supergateway --stdio "$1" --port "$2"
+        echo "WARNING: MCP bridge on port $2 exited; restarting in 1s."
+        sleep 1
+    done
+}
+
+run_bridge "mcp-server-supabase --access-token ${SUPABASE_ACCESS_TOKEN}" "$SUPABASE_MCP_PORT" &
+run_bridge "mcp-server-slack" "$SLACK_MCP_PORT" &
+
+# uvloop and httptools come with uvicorn[standard]; be explicit so a plain
+# asyncio loop is never picked up silently. One worker: see the note above.
+exec python -m uvicorn agent_py.server:app --host 0.0.0.0 --port "$PORT" --loop uvloop --http httptools --workers 1
@@ -50,46 +50,47 @@ async def test_supabase_mcp():
         for i, tool in enumerate(tools, 1):
             print(f"  {i}. {tool.name}")
         
+        # The three tool calls are independent, so run them concurrently and
+        # report each result (or error) in order afterwards.
+        print("\n🚀 Calling list_projects, list_tables and execute_sql concurrently...")
+        projects_result, tables_result, sql_result = await asyncio.gather(
+            supabase_mcp_server.execute_tool("list_projects", {}),
+            supabase_mcp_server.execute_tool("list_tables", {"schemas": ["public"]}),
+            supabase_mcp_server.execute_tool(
+                "execute_sql",
+                {"sql": "SELECT current_timestamp as time, current_database() as db"}
+            ),
+            return_exceptions=True,
+        )
+
         # Test listing projects
         print("\n🏢 Testing list_projects tool...")
-        try:
-            projects_result = await supabase_mcp_server.execute_tool(
-                "list_projects", 
-                {}
-            )
+        if isinstance(projects_result, Exception):
+            print(f"❌ Error listing projects: {projects_result}")
+        else:
             print("✅ Successfully listed projects:")
             for project in projects_result:
                 print(f"  - {project.get('name', 'Unknown')} ({project.get('id', 'Unknown ID')})")
-        except Exception as e:
-            print(f"❌ Error listing projects: {e}")
-        
+
         # Test listing tables (if project is scoped)
         print("\n📊 Testing list_tables tool...")
-        try:
-            tables_result = await supabase_mcp_server.execute_tool(
-                "list_tables", 
-                {"schemas": ["public"]}
-            )
+        if isinstance(tables_result, Exception):
+            print(f"❌ Error listing tables: {tables_result}")
+            print("   This may be expected if the server is not scoped to a specific project.")
+        else:
             print("✅ Successfully listed tables:")
             for table in tables_result:
                 print(f"  - {table}")
-        except Exception as e:
-            print(f"❌ Error listing tables: {e}")
-            print("   This may be expected if the server is not scoped to a specific project.")
-        
+
         # Test executing SQL (if project is scoped)
         print("\n🔍 Testing execute_sql tool...")
-        try:
-            sql_result = await supabase_mcp_server.execute_tool(
-                "execute_sql", 
-                {"sql": "SELECT current_timestamp as time, current_database() as db"}
-            )
+        if isinstance(sql_result, Exception):
+            print(f"❌ Error executing SQL: {sql_result}")
+            print("   This may be expected if the server is not scoped to a specific project.")
+        else:
             print("✅ Successfully executed SQL query:")
             print(f"  Result: {sql_result}")
-        except Exception as e:
-            print(f"❌ Error executing SQL: {e}")
-            print("   This may be expected if the server is not scoped to a specific project.")
-        
+
     except Exception as e:
         print(f"❌ Error connecting to Supabase MCP server: {e}")
     finally:
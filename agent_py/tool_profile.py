@@ -0,0 +1,93 @@
+"""
+Lean tool profile for the MCP servers.
+
+Every tool schema the agent can see is sent to the model on every turn. By
+default only a small allowlist of MCP tools is exposed, with descriptions
+trimmed; the model can load the rest on demand through ``expand_tools``.
+Set ``MCP_TOOL_PROFILE=full`` to expose every tool as before.
+"""
+
+import contextvars
+import os
+
+MCP_TOOL_PROFILE = os.getenv("MCP_TOOL_PROFILE", "lean")
+
+# Entries are tool names, or "<server name>:*" to expose every tool of a server.
+LEAN_TOOL_ALLOWLIST = frozenset(
+    entry.strip()
+    for entry in os.getenv(
+        "MCP_LEAN_TOOLS",
+        "primary_railway:*,"
+        "list_projects,list_tables,execute_sql,"
+        "slack_list_channels,slack_get_channel_history,slack_get_thread_replies,"
+        "slack_post_message,slack_reply_to_thread",
+    ).split(",")
+    if entry.strip()
+)
+LEAN_DESCRIPTION_MAX_CHARS = 200
+
+# Tools unlocked by expand_tools during the current request.
+_expanded_tools: contextvars.ContextVar[set[str] | None] = contextvars.ContextVar("expanded_tools", default=None)
+# server name -> {tool name: description} as last listed, used by expand_tools.
+_tool_catalogue: dict[str, dict[str, str]] = {}
+
+
+def begin_tool_session() -> None:
+    """Start a fresh set of expanded tools for the current request."""
+    _expanded_tools.set(set())
+
+
+def _is_lean(server_name: str, tool_name: str) -> bool:
+    return tool_name in LEAN_TOOL_ALLOWLIST or f"{server_name}:*" in LEAN_TOOL_ALLOWLIST
+
+
+class LeanToolsMixin:
+    """Filters ``list_tools`` down to the lean profile plus any expanded tools."""
+
+    async def list_tools(self, *args, **kwargs):
+        tools = await super().list_tools(*args, **kwargs)
+        _tool_catalogue[self.name] = {tool.name: tool.description or "" for tool in tools}
+        if MCP_TOOL_PROFILE == "full":
+            return tools
+        expanded = _expanded_tools.get() or ()
+        exposed = []
+        for tool in tools:
+            if tool.name in expanded:
+                exposed.append(tool)
+            elif _is_lean(self.name, tool.name):
+                if tool.description and len(tool.description) > LEAN_DESCRIPTION_MAX_CHARS:
+                    tool = tool.model_copy(update={"description": tool.description[:LEAN_DESCRIPTION_MAX_CHARS - 3] + "..."})
+                exposed.append(tool)
+        return exposed
+
+
+def expand_tools(names: list[str]) -> str:
+    """Load additional tools for the rest of this request. Call with an empty list to see which extra tools exist.
+
+    Args:
+        names: Names of the tools to load.
+    """
+    hidden = {
+        tool_name: description
+        for server_name, tools in _tool_catalogue.items()
+        for tool_name, description in tools.items()
+        if not _is_lean(server_name, tool_name)
+    }
+    expanded = _expanded_tools.get()
+    if expanded is None:
+        expanded = set()
+        _expanded_tools.set(expanded)
+    loaded = [name for name in names if name in hidden]
+    expanded.update(loaded)
+    unknown = [name for name in names if name not in hidden]
+
+    lines = []
+    if loaded:
+        lines.append(f"Loaded: {', '.join(loaded)}. They are available from your next step.")
+    if unknown or not names:
+        if unknown:
+            lines.append(f"Not found: {', '.join(unknown)}.")
+        remaining = [f"- {name}: {description[:80]}" for name, description in sorted(hidden.items()) if name not in expanded]
+        lines.append("Tools that can be loaded:" if remaining else "No further tools are available.")
+        lines.extend(remaining)
+    return "\n".join(lines)
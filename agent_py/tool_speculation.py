@@ -0,0 +1,118 @@
+"""
+Speculative dispatch of read-only MCP tool calls.
+
+The model names the tool it wants before it has finished streaming the call's
+arguments. For a handful of side-effect-free tools whose arguments are easy to
+predict, the call is started as soon as the name is known, and the real call
+picks up the result if the model asks for exactly those arguments.
+"""
+
+import asyncio
+import logging
+import time
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Tool name -> the arguments we bet the model will use. Only tools that are
+# read-only and cheap belong here: a speculative call may be thrown away.
+SPECULATIVE_TOOL_PRIOR: dict[str, dict] = {
+    "slack_list_channels": {},
+    "list_projects": {},
+    "list_organizations": {},
+}
+SPECULATION_MAX_IN_FLIGHT = 3
+# A speculative result older than this is never handed to a call_tool; it may
+# belong to a run that ended without cleaning up, and its data may be stale.
+SPECULATION_MAX_AGE_SECONDS = 30.0
+
+
+def _call_key(tool_name: str, arguments: dict | None) -> tuple[str, bytes]:
+    return tool_name, orjson.dumps(arguments or {}, option=orjson.OPT_SORT_KEYS)
+
+
+def _consume_task_result(task: asyncio.Task) -> None:
+    # Losing speculations are never awaited; read their outcome so asyncio
+    # does not warn about an unretrieved exception.
+    if not task.cancelled():
+        task.exception()
+
+
+class SpeculativeToolCallsMixin:
+    """Lets ``call_tool`` reuse a matching call that a ToolSpeculator already started."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # call key -> (task, time.monotonic() when it was started)
+        self._speculative_calls: dict[tuple[str, bytes], tuple[asyncio.Task, float]] = {}
+
+    def _pop_fresh_speculative_call(self, key) -> asyncio.Task | None:
+        entry = self._speculative_calls.pop(key, None)
+        if entry is None:
+            return None
+        task, started_at = entry
+        if time.monotonic() - started_at > SPECULATION_MAX_AGE_SECONDS:
+            task.cancel()
+            return None
+        return task
+
+    def start_speculative_call(self, tool_name: str, arguments: dict) -> asyncio.Task | None:
+        key = _call_key(tool_name, arguments)
+        entry = self._speculative_calls.get(key)
+        if entry is not None and time.monotonic() - entry[1] <= SPECULATION_MAX_AGE_SECONDS:
+            return None
+        if entry is not None:
+            entry[0].cancel()
+        task = asyncio.create_task(super().call_tool(tool_name, arguments))
+        task.add_done_callback(_consume_task_result)
+        self._speculative_calls[key] = (task, time.monotonic())
+        return task
+
+    def discard_speculative_call(self, tool_name: str, arguments: dict, task: asyncio.Task) -> None:
+        key = _call_key(tool_name, arguments)
+        entry = self._speculative_calls.get(key)
+        if entry is not None and entry[0] is task:
+            del self._speculative_calls[key]
+            task.cancel()
+
+    async def call_tool(self, tool_name, arguments, *args, **kwargs):
+        task = self._pop_fresh_speculative_call(_call_key(tool_name, arguments)) if self._speculative_calls else None
+        if task is not None:
+            try:
+                return await task
+            except Exception as e:
+                logger.debug("Speculative '%s' call failed (%s); calling again.", tool_name, e)
+        return await super().call_tool(tool_name, arguments, *args, **kwargs)
+
+
+class ToolSpeculator:
+    """Starts likely tool calls for one agent run and cancels the ones that were not used."""
+
+    def __init__(self, mcp_servers):
+        self._mcp_servers = mcp_servers
+        self._started: list[tuple[object, str, dict, asyncio.Task]] = []
+
+    def _owner_of(self, tool_name: str):
+        for server_instance in self._mcp_servers:
+            tools = getattr(server_instance, "cached_tools", None) or []
+            if any(tool.name == tool_name for tool in tools):
+                return server_instance
+        return None
+
+    def speculate(self, tool_name: str) -> None:
+        arguments = SPECULATIVE_TOOL_PRIOR.get(tool_name)
+        if arguments is None or len(self._started) >= SPECULATION_MAX_IN_FLIGHT:
+            return
+        server_instance = self._owner_of(tool_name)
+        if server_instance is None or not hasattr(server_instance, "start_speculative_call"):
+            return
+        task = server_instance.start_speculative_call(tool_name, arguments)
+        if task is not None:
+            logger.debug("Speculatively calling '%s' on '%s'.", tool_name, server_instance.name)
+            self._started.append((server_instance, tool_name, arguments, task))
+
+    def cancel_pending(self) -> None:
+        for server_instance, tool_name, arguments, task in self._started:
+            server_instance.discard_speculative_call(tool_name, arguments, task)
+        self._started.clear()
@@ -33,7 +33,8 @@ export class PythonAgentClient implements AIProvider {
                 `${env.PY_AGENT_URL}/generate`,
                 {
                     prompt,
-                    history: conversationHistory
+                    history: conversationHistory,
+                    session_id: options?.sessionId
                 },
                 {
                     responseType: 'stream',
@@ -52,33 +53,28 @@ export class PythonAgentClient implements AIProvider {
             return;
         }
 
+        // The agent streams Server-Sent Events: frames separated by a blank line,
+        // each carrying one JSON event on a `data:` line.
         let buffer = '';
         try {
             for await (const chunk of responseStream) {
                 buffer += chunk.toString();
-                let newlineIndex;
-                while ((newlineIndex = buffer.indexOf('\n')) >= 0) {
-                    const line = buffer.substring(0, newlineIndex).trim();
-                    buffer = buffer.substring(newlineIndex + 1);
-
-                    if (line) {
-                        try {
-                            const event: AgentStreamEvent = JSON.parse(line);
-                            logger.debug(`${logEmoji.ai} Parsed event from stream: ${event.type}`);
-                            yield event;
-                        } catch (parseError) {
-                            logger.warn(`${logEmoji.warning} Failed to parse JSON line from stream: ${line}`, { parseError });
-                        }
+                let frameEnd;
+                while ((frameEnd = buffer.indexOf('\n\n')) >= 0) {
+                    const frame = buffer.substring(0, frameEnd);
+                    buffer = buffer.substring(frameEnd + 2);
+                    const event = this.parseEventFrame(frame);
+                    if (event) {
+                        logger.debug(`${logEmoji.ai} Parsed event from stream: ${event.type}`);
+                        yield event;
                     }
                 }
             }
             if (buffer.trim()) {
                 logger.debug(`${logEmoji.ai} Processing remaining buffer data: ${buffer.trim()}`);
-                try {
-                    const event: AgentStreamEvent = JSON.parse(buffer.trim());
+                const event = this.parseEventFrame(buffer);
+                if (event) {
                     yield event;
-                } catch (parseError) {
-                    logger.warn(`${logEmoji.warning} Failed to parse final JSON line from stream: ${buffer.trim()}`, { parseError });
                 }
             }
             logger.info(`${logEmoji.ai} Finished processing stream from Python agent.`);
@@ -93,6 +89,26 @@ export class PythonAgentClient implements AIProvider {
         }
     }
 
+    /**
+     * Parses one SSE frame into an event; returns null for comments, empty or malformed frames.
+     */
+    private parseEventFrame(frame: string): AgentStreamEvent | null {
+        const data = frame
+            .split('\n')
+            .filter(line => line.startsWith('data:'))
+            .map(line => line.slice(line.startsWith('data: ') ? 6 : 5))
+            .join('\n');
+        if (!data) {
+            return null;
+        }
+        try {
+            return JSON.parse(data);
+        } catch (parseError) {
+            logger.warn(`${logEmoji.warning} Failed to parse JSON event from stream: ${data}`, { parseError });
+            return null;
+        }
+    }
+
     async generateResponse(
         prompt: string | MessageContent[],
         conversationHistory: ConversationMessage[],
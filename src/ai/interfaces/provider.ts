@@ -109,6 +109,8 @@ export interface GenerateOptions {
     maxTokens?: number;
     topP?: number;
     stream?: boolean;
+    /** Stable id of the conversation (e.g. Slack channel + thread), used for prompt caching */
+    sessionId?: string;
 }
 
 /**
@@ -184,7 +184,9 @@ async function processMessageAndGenerateResponse(
         // 3. Call the STREAMING function of the AI client
         const eventStream = aiClient.generateResponseStream(
             promptForAI,
-            conversationHistory
+            conversationHistory,
+            undefined,
+            { sessionId: `${threadInfo.channelId}:${threadInfo.threadTs}` }
         );
 
         // 4. Process the events from the stream